@@ -0,0 +1,156 @@
+"""
+XML streaming and row building shared by ingest_timetables.py and ingest_changes.py.
+
+This is the XML streaming (iter_s) and the per-<s> inner loop (attribute
+lookups, time keys, COPY escaping), i.e. most of the Python CPU time of an
+ingest. It is kept in its own module with full type annotations so it can be
+compiled ahead of time:
+
+    pip install mypy
+    cd ETL_pipeline && mypyc _row_builder.py
+
+That drops a _row_builder.*.so next to this file, which Python then imports
+instead of the .py. Without it everything runs as plain Python, same results.
+"""
+
+from typing import Any, Iterator
+
+from lxml import etree as ET  # type: ignore[import-untyped]  # no stubs, stays Any for mypyc
+
+
+# iterparse cannot take a prebuilt XMLParser, it sets up its own per file from
+# these options. Whitespace-only text is never read, so it is dropped instead of
+# stored; entities are not resolved (nothing in the DB feed uses them) and no
+# xml:id table is built (collect_ids).
+ITERPARSE_OPTS: dict[str, bool] = dict(remove_blank_text=True, resolve_entities=False,
+                                       collect_ids=False)
+
+
+def iter_s(fp: str) -> Iterator[Any]:
+    """
+    One streaming pass over a station XML. Yields the root <timetable> first
+    (for @eva / @station), then every <s>. Each <s> is cleared, together with
+    the already processed siblings, as soon as the caller asks for the next one,
+    so the file never sits fully in memory.
+    """
+    for ev, el in ET.iterparse(fp, events=("start", "end"), tag=("timetable", "s"),
+                               **ITERPARSE_OPTS):
+        if ev == "start":
+            if el.tag == "timetable":
+                yield el
+        elif el.tag == "s":
+            yield el
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+
+
+def safe_timekey_from_attr(v: str | None) -> int | None:
+    # YYMMDDHHMM -> YYYYMMDDHHMM is just "+ 2000 * 10^8", no datetime needed.
+    if v and len(v) == 10 and v.isdigit():
+        return 200000000000 + int(v)
+    return None
+
+
+def copy_value(v: object) -> str:
+    # COPY text format: \N is NULL, backslash/tab/newline must be escaped.
+    if v is None:
+        return "\\N"
+    if v is True:
+        return "t"
+    if v is False:
+        return "f"
+    if isinstance(v, str):
+        return (v.replace("\\", "\\\\").replace("\t", "\\t")
+                 .replace("\n", "\\n").replace("\r", "\\r"))
+    return str(v)
+
+
+def copy_line(values: tuple) -> str:
+    return "\t".join([copy_value(v) for v in values])
+
+
+def train_tuple(tl: Any) -> tuple[str, str, str, str, str]:
+    # dim_train natural key; missing parts filled so the UNIQUE key stays stable
+    return (
+        tl.get("c") or "UNK",
+        tl.get("n") or "UNK",
+        tl.get("o") or "",
+        tl.get("t") or "",
+        tl.get("f") or "",
+    )
+
+
+def split_children(s: Any) -> tuple[Any, Any, Any]:
+    # One pass over the children of <s> instead of three s.find() scans.
+    # Returns (tl attrib or None, ar element or None, dp element or None).
+    tl = ar = dp = None
+    for ch in s:
+        t = ch.tag
+        if t == "ar":
+            ar = ch
+        elif t == "dp":
+            dp = ch
+        elif t == "tl":
+            tl = ch.attrib
+    return tl, ar, dp
+
+
+def process_planned_element(s: Any, station_key: int, snap_key: int) -> list[tuple]:
+    """
+    One <s> of a planned timetable -> rows (train natural key, COPY line of
+    the stg_fact_planned columns after train_key).
+    """
+    rows: list[tuple] = []
+    stop_id = s.attrib.get("id")
+    tl, ar, dp = split_children(s)
+    train = train_tuple(tl if tl is not None else {})
+
+    for ev, etype in ((ar, "A"), (dp, "D")):
+        if ev is None:
+            continue
+        a = ev.attrib
+        rows.append((train, copy_line((
+            station_key,
+            snap_key,
+            stop_id,
+            etype,
+            safe_timekey_from_attr(a.get("pt")),
+            a.get("pp"),
+            a.get("l"),
+            a.get("ppth"),
+        ))))
+    return rows
+
+
+def process_change_element(s: Any, station_key: int, snap_key: int) -> list[tuple]:
+    """
+    One <s> of a timetable_changes XML -> rows (train natural key or None,
+    COPY line of the stg_fact_movement columns after train_key). None means
+    the stop had no <tl>; it gets the UNK train when staged.
+    """
+    rows: list[tuple] = []
+    stop_id = s.attrib.get("id")
+    tl, ar, dp = split_children(s)
+    # Many change XMLs don't have tl at all -> None, staged as the UNK train.
+    train = train_tuple(tl) if tl else None
+
+    for ev, etype in ((ar, "A"), (dp, "D")):
+        if ev is None:
+            continue
+        a = ev.attrib
+        rows.append((train, copy_line((
+            station_key,
+            snap_key,
+            stop_id,
+            etype,
+            safe_timekey_from_attr(a.get("pt")),
+            safe_timekey_from_attr(a.get("ct")),
+            a.get("cs"),     # p/a/c (often missing), is_cancelled comes from it in SQL
+            a.get("pp"),     # planned platform (sometimes present in changes)
+            a.get("cp"),     # changed platform (optional)
+            a.get("l"),
+            a.get("ppth"),
+            a.get("dc"),     # delay delta in minutes (if present), parsed in SQL
+        ))))
+    return rows
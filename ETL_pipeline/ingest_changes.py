@@ -4,98 +4,149 @@ Ingest DB timetable_changes (15-min snapshots) into my DIA schema.
 
 What I do here:
 - Each snapshot folder name (YYMMDDHHMM) is the snapshot timestamp.
+- dim_time is not written here: time keys are plain YYYYMMDDHHMM ints and the
+  table is filled once up front with prepopulate_dim_time.py.
 - For each station XML inside that folder, I use root @eva to map to dim_station.
-- I upsert (insert/update) fact_train_movement by the natural key:
+- Rows are COPY'd into a session-local staging table and merged into
+  fact_train_movement once per snapshot (one set-based upsert) by the natural key:
   (snapshot_time_key, station_key, stop_id, event_type)
+- Snapshots run in parallel worker processes, each with its own connection;
+  every snapshot is still committed on its own.
+- Committed snapshots are recorded in ingest_watermark; a re-run skips them and
+  only re-reads station files modified since (use --full to redo everything).
+- Worker sessions run with synchronous_commit=off: a crash can lose the most
+  recent snapshot commit(s). Just re-run the ingest, the merge is idempotent.
 """
 
+import io
 import os
+import functools
 import re
 import argparse
-import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from multiprocessing.util import Finalize
 
 import psycopg2
-from psycopg2.extras import execute_batch
+from lxml import etree as ET
+from psycopg2.extensions import make_dsn
+from psycopg2.extras import execute_values
 
-SNAP_RE = re.compile(r"^\d{10}$")  # YYMMDDHHMM, e.g. 2509021615
-
-
-
-# Time helpers
-def parse_yymmddhhmm(s: str) -> datetime:
-    s = (s or "").strip()
-    if len(s) != 10 or not s.isdigit():
-        raise ValueError(f"Invalid YYMMDDHHMM: {s}")
-    yy = 2000 + int(s[0:2])
-    mm = int(s[2:4])
-    dd = int(s[4:6])
-    hh = int(s[6:8])
-    mi = int(s[8:10])
-    return datetime(yy, mm, dd, hh, mi)
-
-
-def time_key(dt: datetime) -> int:
-    return int(dt.strftime("%Y%m%d%H%M"))
-
-
-def safe_timekey_from_attr(v: str):
-    if v and v.isdigit() and len(v) == 10:
-        return time_key(parse_yymmddhhmm(v))
-    return None
-
-
-def compute_delay_minutes(pt_key: int | None, ct_key: int | None, dc: str | None):
-    # If dc exists and is numeric, it is the most direct delay signal.
-    if dc and dc.lstrip("-").isdigit():
-        return int(dc)
-
-    if not pt_key or not ct_key:
-        return None
-
-    pt_dt = datetime.strptime(str(pt_key), "%Y%m%d%H%M")
-    ct_dt = datetime.strptime(str(ct_key), "%Y%m%d%H%M")
-    return int(round((ct_dt - pt_dt).total_seconds() / 60.0))
+from _row_builder import iter_s, process_change_element, safe_timekey_from_attr
+from prepopulate_dim_time import check_dim_time_covers
 
+SNAP_RE = re.compile(r"^\d{10}$")  # YYMMDDHHMM, e.g. 2509021615
 
 
 # Folder iteration
 def iter_snapshot_dirs(week_dir: str):
-    for entry in sorted(os.listdir(week_dir)):
-        path = os.path.join(week_dir, entry)
-        if os.path.isdir(path) and SNAP_RE.match(entry):
-            yield entry, path
-
-
-def iter_xml_files(snapshot_path: str):
-    for fn in sorted(os.listdir(snapshot_path)):
-        if fn.lower().endswith(".xml"):
-            yield fn, os.path.join(snapshot_path, fn)
+    # One scandir pass: DirEntry gets the file type from the dirent, so no extra
+    # stat() per entry (os.path.isdir did one each).
+    with os.scandir(week_dir) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_dir() and SNAP_RE.match(e.name):
+            yield e.name, e.path
+
+
+def iter_xml_files(snapshot_path: str, newer_than: float | None = None):
+    # newer_than (epoch seconds): only files modified after it, see ingest_watermark.
+    with os.scandir(snapshot_path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_file() and e.name.lower().endswith(".xml"):
+            if newer_than is not None and e.stat().st_mtime <= newer_than:
+                continue
+            yield e.name, e.path
 
 
 
 # SQL
-SQL_UPSERT_TIME = """
-INSERT INTO dim_time (time_key, ts, date, hour, minute, dow, is_weekend)
-VALUES (%s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT (time_key) DO NOTHING;
-"""
-
+# The no-op DO UPDATE is on purpose: with DO NOTHING, RETURNING gives no row
+# on conflict. This way one statement returns the key for new and old trains.
 SQL_UPSERT_TRAIN = """
 INSERT INTO dim_train (category, train_number, owner, trip_type, filter_flags)
 VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (category, train_number, owner, trip_type, filter_flags)
+DO UPDATE SET category = EXCLUDED.category
+RETURNING train_key;
+"""
+
+# Bulk versions for a whole batch of new trains (VALUES %s -> execute_values).
+SQL_INSERT_TRAINS = """
+INSERT INTO dim_train (category, train_number, owner, trip_type, filter_flags)
+VALUES %s
 ON CONFLICT (category, train_number, owner, trip_type, filter_flags) DO NOTHING;
 """
 
-SQL_SELECT_TRAIN_KEY = """
-SELECT train_key
+SQL_SELECT_TRAINS = """
+SELECT train_key, category, train_number, owner, trip_type, filter_flags
 FROM dim_train
-WHERE category=%s AND train_number=%s AND owner=%s AND trip_type=%s AND filter_flags=%s;
+WHERE (category, train_number, owner, trip_type, filter_flags) IN (VALUES %s);
+"""
+
+# One row per fully committed snapshot. committed_at is taken when the worker
+# *started* reading the folder, so files touched during the ingest are newer
+# than it and get picked up by the next run.
+SQL_CREATE_WATERMARK = """
+CREATE TABLE IF NOT EXISTS ingest_watermark (
+  week_dir      TEXT NOT NULL,
+  snapshot_str  TEXT NOT NULL,
+  committed_at  TIMESTAMP NOT NULL,
+  PRIMARY KEY (week_dir, snapshot_str)
+);
 """
 
+SQL_SELECT_WATERMARK = """
+SELECT snapshot_str, committed_at FROM ingest_watermark WHERE week_dir = %s;
+"""
+
+SQL_UPSERT_WATERMARK = """
+INSERT INTO ingest_watermark (week_dir, snapshot_str, committed_at)
+VALUES (%s, %s, %s)
+ON CONFLICT (week_dir, snapshot_str) DO UPDATE SET committed_at = EXCLUDED.committed_at;
+"""
+
+# Staging table for one snapshot. TEMP = per session and not WAL-logged;
+# stg_id keeps the COPY order so the merge can pick the last row per key.
+SQL_CREATE_STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS stg_fact_movement (
+  stg_id             BIGSERIAL,
+  station_key        BIGINT,
+  train_key          BIGINT,
+  snapshot_time_key  BIGINT,
+  stop_id            TEXT,
+  event_type         CHAR(1),
+  planned_time_key   BIGINT,
+  changed_time_key   BIGINT,
+  event_status       CHAR(1),
+  planned_platform   TEXT,
+  changed_platform   TEXT,
+  line               TEXT,
+  planned_path       TEXT,
+  delay_change       TEXT        -- raw @dc, turned into delay_minutes by the merge
+);
+"""
+
+# COPY column order: train_key first, because it is the only column filled in
+# by the main process (see stage_rows); parse_one_xml() pre-encodes the rest.
+STG_COLUMNS = (
+    "train_key", "station_key", "snapshot_time_key",
+    "stop_id", "event_type",
+    "planned_time_key", "changed_time_key",
+    "event_status",
+    "planned_platform", "changed_platform",
+    "line", "planned_path",
+    "delay_change",
+)
+
+SQL_COPY_STAGING = f"COPY stg_fact_movement ({', '.join(STG_COLUMNS)}) FROM STDIN"
+
 # I prefer explicit columns here (more portable than relying on a constraint name).
 # Natural key is (snapshot_time_key, station_key, stop_id, event_type).
-SQL_UPSERT_FACT_CHANGES = """
+# DISTINCT ON: one INSERT cannot touch the same fact row twice, so if a key shows
+# up more than once in the staging table the last copied row wins.
+SQL_MERGE_FACT_CHANGES = """
 INSERT INTO fact_train_movement (
   station_key, train_key, snapshot_time_key,
   stop_id, event_type,
@@ -105,7 +156,27 @@ INSERT INTO fact_train_movement (
   line, planned_path,
   delay_minutes, is_cancelled
 )
-VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s)
+SELECT DISTINCT ON (snapshot_time_key, station_key, stop_id, event_type)
+  station_key, train_key, snapshot_time_key,
+  stop_id, event_type,
+  planned_time_key, changed_time_key,
+  event_status,
+  planned_platform, changed_platform,
+  line, planned_path,
+  -- numeric @dc is the most direct delay signal, else ct - pt in minutes.
+  -- to_date() differences are whole days, so no time zone/DST gets involved.
+  -- mod() instead of the modulo operator: this statement is run with a
+  -- parameter, so psycopg2 would take that operator for a placeholder.
+  CASE
+    WHEN delay_change ~ '^-?[0-9]+$' THEN delay_change::int
+    ELSE (to_date((changed_time_key / 10000)::text, 'YYYYMMDD')
+          - to_date((planned_time_key / 10000)::text, 'YYYYMMDD')) * 1440
+         + (mod(changed_time_key / 100, 100) - mod(planned_time_key / 100, 100)) * 60
+         + (mod(changed_time_key, 100) - mod(planned_time_key, 100))
+  END,
+  COALESCE(event_status = 'c', false)
+FROM stg_fact_movement
+ORDER BY snapshot_time_key, station_key, stop_id, event_type, stg_id DESC
 ON CONFLICT (snapshot_time_key, station_key, stop_id, event_type)
 DO UPDATE SET
   -- Do NOT overwrite a real train_key with the UNK train.
@@ -131,156 +202,300 @@ DO UPDATE SET
 """
 
 
-def upsert_time(cur, dt: datetime, cache: set[int]) -> int:
-    k = time_key(dt)
-    if k in cache:
-        return k
-    cur.execute(SQL_UPSERT_TIME, (
-        k, dt, dt.date(), dt.hour, dt.minute, dt.isoweekday(), (dt.weekday() >= 5)
-    ))
-    cache.add(k)
-    return k
+# Ingest session settings. synchronous_commit=off turns each per-snapshot commit
+# into a memory write; after a crash the last few commits (bounded by
+# wal_writer_delay) can be missing, which is fine since the ingest is re-runnable.
+SQL_TUNE_SESSION = (
+    "SET synchronous_commit = off;",
+    "SET work_mem = '256MB';",
+)
+
+
+def tune_session(cur):
+    for stmt in SQL_TUNE_SESSION:
+        cur.execute(stmt)
+
+
+def set_fact_autovacuum(dsn: str, enabled: bool):
+    # --unsafe-fast: no autovacuum IO competing with the ingest; when turning it
+    # back on, VACUUM ANALYZE once so the table is in shape for the queries.
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True  # VACUUM can't run inside a transaction
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE fact_train_movement SET (autovacuum_enabled = %s);", (enabled,))
+            if enabled:
+                cur.execute("SET maintenance_work_mem = '1GB';")
+                cur.execute("VACUUM ANALYZE fact_train_movement;")
+    finally:
+        conn.close()
+
+
+# dim_station only ever grows, so its max key works as a cheap "version".
+SQL_STATION_VERSION = "SELECT COALESCE(MAX(station_key), 0) FROM dim_station;"
+
+
+@functools.lru_cache(maxsize=1)
+def _load_station_map(dsn: str, version_tag: int) -> dict[int, int]:
+    # EVA -> station_key. version_tag is only part of the cache key: the map is
+    # re-read once stations were added, otherwise repeat ingests in the same
+    # process get the cached dict (treat it as read-only).
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT eva, station_key FROM dim_station;")
+            return {int(e): int(k) for (e, k) in cur.fetchall()}
+    finally:
+        conn.close()
 
 
 def ensure_unknown_train(cur) -> int:
     # One shared "UNK" train row, used only when <tl> is missing.
     unk = ("UNK", "UNK", "", "", "")
     cur.execute(SQL_UPSERT_TRAIN, unk)
-    cur.execute(SQL_SELECT_TRAIN_KEY, unk)
     return cur.fetchone()[0]
 
 
-def get_train_key(cur, tl: dict, train_cache: dict, unknown_train_key: int) -> int:
-    # Many change XMLs don't have tl at all.
-    if not tl:
-        return unknown_train_key
+def resolve_train_keys(cur, keys: set, train_cache: dict):
+    # All trains of a batch that are not cached yet: one multi-row INSERT plus
+    # one SELECT, instead of one round trip per new train.
+    # cur is the worker's autocommit connection, so new trains are committed
+    # right away and no other worker ever waits on them until our snapshot ends.
+    new = sorted(k for k in keys if k is not None and k not in train_cache)
+    if not new:
+        return
+    execute_values(cur, SQL_INSERT_TRAINS, new, page_size=1000)
+    for train_key, *key in execute_values(cur, SQL_SELECT_TRAINS, new, page_size=1000, fetch=True):
+        train_cache[tuple(key)] = train_key
+
+
+def stage_rows(cur, train_cur, rows: list, train_cache: dict, unknown_train_key: int):
+    # Rows are (train natural key, COPY text of all other columns): resolve the
+    # batch's trains (on train_cur), prepend train_key to each line and COPY it
+    # (on cur, inside the snapshot transaction). No per-row tuples are rebuilt
+    # here, the workers already did the encoding.
+    resolve_train_keys(train_cur, {train for train, _ in rows}, train_cache)
+    buf = io.StringIO()
+    for train, tail in rows:
+        buf.write(f"{train_cache[train] if train else unknown_train_key}\t{tail}\n")
+    buf.seek(0)
+    cur.copy_expert(SQL_COPY_STAGING, buf)
+
+
+# XML parsing (runs inside the snapshot worker processes)
+_station_key_by_eva: dict[int, int] = {}
+
+
+def parse_one_xml(args) -> tuple[str, list]:
+    """
+    Turn one station XML into fact rows. Returns (status, rows) with
+    status "ok", "bad_xml" or "skipped_station". Each row is
+    (train natural key, COPY line of the remaining STG_COLUMNS); the train_key
+    is resolved later in the main process (stage_rows).
+    """
+    fp, snap_key = args
+    elements = iter_s(fp)
+    try:
+        root = next(elements)
+    except Exception:
+        return "bad_xml", []
 
-    category = tl.get("c") or "UNK"
-    number   = tl.get("n") or "UNK"
-    owner    = tl.get("o") or ""
-    ttype    = tl.get("t") or ""
-    flags    = tl.get("f") or ""
+    eva_attr = root.attrib.get("eva")
+    if not eva_attr or not eva_attr.isdigit():
+        return "skipped_station", []
 
-    key = (category, number, owner, ttype, flags)
-    if key in train_cache:
-        return train_cache[key]
+    station_key = _station_key_by_eva.get(int(eva_attr))
+    if station_key is None:
+        return "skipped_station", []
 
-    cur.execute(SQL_UPSERT_TRAIN, key)
-    cur.execute(SQL_SELECT_TRAIN_KEY, key)
-    train_key = cur.fetchone()[0]
-    train_cache[key] = train_key
-    return train_key
+    rows = []
+    try:
+        for s in elements:
+            rows.extend(process_change_element(s, station_key, snap_key))
+    except ET.XMLSyntaxError:
+        # Broken/truncated file: drop whatever I read from it.
+        return "bad_xml", []
 
+    return "ok", rows
 
-def ingest_changes(cur, week_changes_dir: str, batch_size: int = 800):
-    # EVA -> station_key from DB (dim_station should already have 133 rows)
-    cur.execute("SELECT eva, station_key FROM dim_station;")
-    station_key_by_eva = {int(e): int(k) for (e, k) in cur.fetchall()}
 
-    time_cache: set[int] = set()
-    train_cache: dict[tuple, int] = {}
+# Snapshot workers: every process owns one DB connection and its own train_cache.
+_worker: dict = {}
 
-    unknown_train_key = ensure_unknown_train(cur)
 
-    snap_count = 0
-    xml_count = 0
-    upserted = 0
-    skipped_station = 0
-    bad_xml = 0
+def init_worker(dsn: str, station_key_by_eva: dict, unknown_train_key: int, batch_size: int,
+                week_key: str):
+    # Pool initializer: connect once per worker and ship the station map once,
+    # not once per snapshot.
+    global _station_key_by_eva
+    _station_key_by_eva = station_key_by_eva
 
-    for snapshot_str, snapshot_path in iter_snapshot_dirs(week_changes_dir):
-        snap_dt = parse_yymmddhhmm(snapshot_str)
-        snap_key = upsert_time(cur, snap_dt, time_cache)
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = False
+    cur = conn.cursor()
+    tune_session(cur)
+    cur.execute(SQL_CREATE_STAGING)
+    conn.commit()
+
+    # Second connection just for dim_train inserts, one short transaction each.
+    train_conn = psycopg2.connect(dsn)
+    train_conn.autocommit = True
+
+    # The executor has no per-worker teardown hook, but multiprocessing runs
+    # Finalize callbacks when a worker process shuts down normally.
+    Finalize(None, close_worker_connections, args=(conn, train_conn), exitpriority=10)
+
+    _worker.update(
+        cur=cur,
+        train_cur=train_conn.cursor(),
+        train_cache={},
+        unknown_train_key=unknown_train_key,
+        batch_size=batch_size,
+        week_key=week_key,
+    )
 
-        rows = []
 
-        for _, fp in iter_xml_files(snapshot_path):
-            xml_count += 1
-            try:
-                root = ET.parse(fp).getroot()
-            except Exception:
-                bad_xml += 1
-                continue
+def close_worker_connections(*conns):
+    for c in conns:
+        c.close()
 
-            eva_attr = root.attrib.get("eva")
-            if not eva_attr or not eva_attr.isdigit():
-                skipped_station += 1
-                continue
 
-            station_key = station_key_by_eva.get(int(eva_attr))
-            if station_key is None:
-                skipped_station += 1
+def ingest_one_snapshot(snapshot_str: str, snapshot_path: str, newer_than: float | None = None) -> dict:
+    """
+    Full XML -> COPY -> merge -> commit cycle for one snapshot folder, on the
+    worker's own connection. Returns the counters for the progress output.
+    With newer_than set (snapshot already in ingest_watermark) only the station
+    files changed since then are read; if there are none, nothing is done.
+    """
+    cur = _worker["cur"]
+    train_cur = _worker["train_cur"]
+    train_cache = _worker["train_cache"]
+    unknown_train_key = _worker["unknown_train_key"]
+    batch_size = _worker["batch_size"]
+
+    # folder name already passed SNAP_RE, so the key is plain int math
+    snap_key = safe_timekey_from_attr(snapshot_str)
+    counts = {"xml": 0, "upserted": 0, "skipped_station": 0, "bad_xml": 0, "up_to_date": False}
+
+    started = datetime.now()
+    files = list(iter_xml_files(snapshot_path, newer_than))
+    if newer_than is not None and not files:
+        counts["up_to_date"] = True
+        return counts
+
+    try:
+        rows = []
+        staged = 0
+
+        for _, fp in files:
+            counts["xml"] += 1
+            status, file_rows = parse_one_xml((fp, snap_key))
+            if status != "ok":
+                counts[status] += 1
                 continue
 
-            for s in root.findall("s"):
-                stop_id = s.attrib.get("id")
-
-                tl_node = s.find("tl")
-                tl = tl_node.attrib if tl_node is not None else {}
-                train_key = get_train_key(cur, tl, train_cache, unknown_train_key)
-
-                for tag, etype in (("ar", "A"), ("dp", "D")):
-                    ev = s.find(tag)
-                    if ev is None:
-                        continue
-
-                    pt_key = safe_timekey_from_attr(ev.attrib.get("pt"))
-                    ct_key = safe_timekey_from_attr(ev.attrib.get("ct"))
-
-                    # Keep time dimension consistent (I insert whatever I see).
-                    if pt_key:
-                        upsert_time(cur, datetime.strptime(str(pt_key), "%Y%m%d%H%M"), time_cache)
-                    if ct_key:
-                        upsert_time(cur, datetime.strptime(str(ct_key), "%Y%m%d%H%M"), time_cache)
-
-                    cs = ev.attrib.get("cs")     # p/a/c (often missing)
-                    cp = ev.attrib.get("cp")     # changed platform (optional)
-                    pp = ev.attrib.get("pp")     # planned platform (sometimes present in changes)
-                    line = ev.attrib.get("l")
-                    ppth = ev.attrib.get("ppth")
-                    dc = ev.attrib.get("dc")     # delay delta in minutes (if present)
-
-                    delay = compute_delay_minutes(pt_key, ct_key, dc)
-                    is_cancelled = (cs == "c")
-
-                    rows.append((
-                        station_key,
-                        train_key,
-                        snap_key,
-                        stop_id,
-                        etype,
-                        pt_key,
-                        ct_key,
-                        cs,
-                        pp,
-                        cp,
-                        line,
-                        ppth,
-                        delay,
-                        is_cancelled
-                    ))
-
-                    if len(rows) >= batch_size:
-                        # Note: SQL expects unk id at the end for the CASE clause.
-                        execute_batch(cur, SQL_UPSERT_FACT_CHANGES,
-                                      [r + (unknown_train_key,) for r in rows],
-                                      page_size=200)
-                        upserted += len(rows)
-                        rows.clear()
+            rows.extend(file_rows)
+            if len(rows) >= batch_size:
+                stage_rows(cur, train_cur, rows, train_cache, unknown_train_key)
+                staged += len(rows)
+                rows.clear()
 
         if rows:
-            execute_batch(cur, SQL_UPSERT_FACT_CHANGES,
-                          [r + (unknown_train_key,) for r in rows],
-                          page_size=200)
-            upserted += len(rows)
+            stage_rows(cur, train_cur, rows, train_cache, unknown_train_key)
+            staged += len(rows)
             rows.clear()
 
+        if staged:
+            # One set-based upsert for the whole snapshot.
+            # Note: SQL expects unk id as the only parameter (CASE clause).
+            cur.execute(SQL_MERGE_FACT_CHANGES, (unknown_train_key,))
+            counts["upserted"] = cur.rowcount
+            cur.execute("TRUNCATE stg_fact_movement;")
+
+        # Watermark goes into the same transaction as the facts.
+        cur.execute(SQL_UPSERT_WATERMARK, (_worker["week_key"], snapshot_str, started))
+
         # Commit per snapshot: easier to resume / debug.
         cur.connection.commit()
-        snap_count += 1
-        print(f"[snapshot {snapshot_str}] committed. snapshots={snap_count}, xml={xml_count}, upserted~={upserted}, skipped_station={skipped_station}, bad_xml={bad_xml}")
+    except Exception:
+        # Without the rollback the connection stays in an aborted transaction and
+        # every later snapshot of this worker fails too. Trains are committed on
+        # train_cur already, so train_cache stays valid.
+        cur.connection.rollback()
+        raise
 
-    print(f"[DONE] snapshots={snap_count}, xml_files={xml_count}, upserted~={upserted}, skipped_station={skipped_station}, bad_xml={bad_xml}")
+    return counts
+
+
+def ingest_changes(dsn: str, week_changes_dir: str, batch_size: int = 800, workers: int = 4,
+                   use_watermark: bool = True):
+    week_key = os.path.abspath(week_changes_dir)
+    snapshots = list(iter_snapshot_dirs(week_changes_dir))
+
+    # One short setup connection for what all workers share.
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            if snapshots:
+                names = [name for name, _ in snapshots]  # YYMMDDHHMM sorts by time
+                check_dim_time_covers(cur, min(names), max(names))
+
+            cur.execute(SQL_STATION_VERSION)
+            station_version = cur.fetchone()[0]
+            unknown_train_key = ensure_unknown_train(cur)
+
+            # snapshot_str -> committed_at of snapshots already ingested from this week
+            cur.execute(SQL_CREATE_WATERMARK)
+            done = {}
+            if use_watermark:
+                cur.execute(SQL_SELECT_WATERMARK, (week_key,))
+                done = {snap: ts.timestamp() for (snap, ts) in cur.fetchall()}
+        conn.commit()
+    finally:
+        conn.close()
+
+    # EVA -> station_key from DB (dim_station should already have 133 rows),
+    # handed to the workers through the pool initializer.
+    station_key_by_eva = _load_station_map(dsn, station_version)
+
+    snap_count = 0
+    up_to_date = 0
+    xml_count = 0
+    upserted = 0
+    skipped_station = 0
+    bad_xml = 0
+
+    # Snapshots are independent (own snapshot_time_key), so several of them run
+    # at once, each on its own connection: parsing in one worker overlaps with
+    # DB work in the others. New dim_train rows are committed on each worker's
+    # autocommit connection right away (see init_worker), so the long snapshot
+    # transactions never hold locks on them.
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(dsn, station_key_by_eva, unknown_train_key, batch_size,
+                                       week_key)) as ex:
+        results = ex.map(ingest_one_snapshot,
+                         [name for name, _ in snapshots], [path for _, path in snapshots],
+                         [done.get(name) for name, _ in snapshots])
+        try:
+            for (snapshot_str, _), counts in zip(snapshots, results):
+                if counts["up_to_date"]:
+                    up_to_date += 1
+                    print(f"[snapshot {snapshot_str}] up to date, skipped")
+                    continue
+                xml_count += counts["xml"]
+                upserted += counts["upserted"]
+                skipped_station += counts["skipped_station"]
+                bad_xml += counts["bad_xml"]
+                snap_count += 1
+                print(f"[snapshot {snapshot_str}] committed. snapshots={snap_count}, xml={xml_count}, upserted~={upserted}, skipped_station={skipped_station}, bad_xml={bad_xml}")
+        except BaseException:
+            # Stop at the first failed snapshot like the serial version did:
+            # drop the queued ones, otherwise leaving the with-block would wait
+            # for all of them to run (and likely fail the same way) silently.
+            ex.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    print(f"[DONE] snapshots={snap_count}, up_to_date={up_to_date}, xml_files={xml_count}, upserted~={upserted}, skipped_station={skipped_station}, bad_xml={bad_xml}")
 
 
 def main():
@@ -288,6 +503,13 @@ def main():
     ap.add_argument("--week-dir", required=True,
                     help="Path to weekly timetable_changes folder, e.g. .../250902_250909_timetable_changes")
     ap.add_argument("--batch-size", type=int, default=800)
+    ap.add_argument("--workers", type=int, default=4,
+                    help="Snapshots ingested in parallel, one DB connection each")
+    ap.add_argument("--full", action="store_true",
+                    help="Re-ingest every snapshot, ignoring ingest_watermark")
+    ap.add_argument("--unsafe-fast", action="store_true",
+                    help="Disable autovacuum on fact_train_movement during the ingest "
+                         "(re-enabled + VACUUM ANALYZE afterwards)")
 
     ap.add_argument("--pg-host", default=os.getenv("PGHOST", "localhost"))
     ap.add_argument("--pg-port", type=int, default=int(os.getenv("PGPORT", "5432")))
@@ -299,20 +521,21 @@ def main():
     if not args.pg_db or not args.pg_user:
         raise SystemExit("DB config missing. Use --pg-db/--pg-user or set PGDATABASE/PGUSER.")
 
-    conn = psycopg2.connect(
+    dsn = make_dsn(
         host=args.pg_host,
         port=args.pg_port,
         dbname=args.pg_db,
         user=args.pg_user,
         password=args.pg_password,
     )
-    conn.autocommit = False
-    cur = conn.cursor()
+    if args.unsafe_fast:
+        set_fact_autovacuum(dsn, False)
     try:
-        ingest_changes(cur, args.week_dir, batch_size=args.batch_size)
+        ingest_changes(dsn, args.week_dir, batch_size=args.batch_size, workers=args.workers,
+                       use_watermark=not args.full)
     finally:
-        cur.close()
-        conn.close()
+        if args.unsafe_fast:
+            set_fact_autovacuum(dsn, True)
 
 
 if __name__ == "__main__":
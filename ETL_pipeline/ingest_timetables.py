@@ -1,37 +1,25 @@
 
+import io
 import os
 import re
-import json
 import argparse
-import xml.etree.ElementTree as ET
-from datetime import datetime
+import multiprocessing
 
+import orjson
 import psycopg2
-from psycopg2.extras import execute_batch
+from lxml import etree as ET
+from psycopg2.extras import execute_values
+
+from _row_builder import iter_s, process_planned_element, safe_timekey_from_attr
+from prepopulate_dim_time import check_dim_time_covers
 
 
 SNAP_RE = re.compile(r"^\d{10}$")  # YYMMDDHHMM e.g. 2509021200
 
 
 # -----------------------
-# time + station name
+# station name
 # -----------------------
-def parse_yymmddhhmm(s: str) -> datetime:
-    s = str(s).strip()
-    if len(s) != 10 or not s.isdigit():
-        raise ValueError(f"Invalid YYMMDDHHMM: {s}")
-    yy = 2000 + int(s[0:2])
-    mm = int(s[2:4])
-    dd = int(s[4:6])
-    hh = int(s[6:8])
-    mi = int(s[8:10])
-    return datetime(yy, mm, dd, hh, mi)
-
-
-def time_key(dt: datetime) -> int:
-    return int(dt.strftime("%Y%m%d%H%M"))
-
-
 def norm_name(x: str) -> str:
     x = (x or "").strip().lower()
     x = x.replace("_", " ")
@@ -39,8 +27,8 @@ def norm_name(x: str) -> str:
     return x
 
 
-def station_from_root_or_filename(root: ET.Element, filename: str) -> str:
-    st = root.attrib.get("station")
+def station_from_root_or_filename(root_attrib: dict, filename: str) -> str:
+    st = root_attrib.get("station")
     if st:
         return st
     base = os.path.basename(filename)
@@ -53,21 +41,25 @@ def station_from_root_or_filename(root: ET.Element, filename: str) -> str:
 # -----------------------
 def iter_snapshot_dirs(week_dir: str):
     # recursively find folders named exactly 10 digits
-    for entry in sorted(os.listdir(week_dir)):
-        path = os.path.join(week_dir, entry)
-        if not os.path.isdir(path):
+    # (scandir: file type comes with the dir entry, no stat() per entry)
+    with os.scandir(week_dir) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if not e.is_dir():
             continue
-        if SNAP_RE.match(entry):
-            yield entry, path
+        if SNAP_RE.match(e.name):
+            yield e.name, e.path
         else:
             # wrapper folder (if any)
-            yield from iter_snapshot_dirs(path)
+            yield from iter_snapshot_dirs(e.path)
 
 
 def iter_xml_files(snapshot_path: str):
-    for fn in sorted(os.listdir(snapshot_path)):
-        if fn.lower().endswith(".xml"):
-            yield fn, os.path.join(snapshot_path, fn)
+    with os.scandir(snapshot_path) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for e in entries:
+        if e.is_file() and e.name.lower().endswith(".xml"):
+            yield e.name, e.path
 
 
 # -----------------------
@@ -79,7 +71,8 @@ def build_station_maps(station_json_path: str):
       eva_to_station: {eva:int -> (name, lat, lon)}
       name_to_eva: {normalized_name -> eva}
     """
-    data = json.load(open(station_json_path, "r", encoding="utf-8"))
+    with open(station_json_path, "rb") as f:
+        data = orjson.loads(f.read())
     eva_to_station = {}
     name_to_eva = {}
 
@@ -113,34 +106,57 @@ def build_station_maps(station_json_path: str):
 # -----------------------
 # SQL
 # -----------------------
+# VALUES %s -> execute_values sends all stations as one multi-row INSERT
 SQL_UPSERT_STATION = """
 INSERT INTO dim_station (eva, station_name, lat, lon)
-VALUES (%s, %s, %s, %s)
+VALUES %s
 ON CONFLICT (eva) DO UPDATE
 SET station_name = EXCLUDED.station_name,
     lat = EXCLUDED.lat,
     lon = EXCLUDED.lon;
 """
 
-SQL_UPSERT_TIME = """
-INSERT INTO dim_time (time_key, ts, date, hour, minute, dow, is_weekend)
-VALUES (%s, %s, %s, %s, %s, %s, %s)
-ON CONFLICT (time_key) DO NOTHING;
-"""
-
-SQL_UPSERT_TRAIN = """
+# bulk dim_train lookup for all new trains of a batch (VALUES %s -> execute_values)
+SQL_INSERT_TRAINS = """
 INSERT INTO dim_train (category, train_number, owner, trip_type, filter_flags)
-VALUES (%s, %s, %s, %s, %s)
+VALUES %s
 ON CONFLICT (category, train_number, owner, trip_type, filter_flags) DO NOTHING;
 """
 
-SQL_SELECT_TRAIN_KEY = """
-SELECT train_key
+SQL_SELECT_TRAINS = """
+SELECT train_key, category, train_number, owner, trip_type, filter_flags
 FROM dim_train
-WHERE category=%s AND train_number=%s AND owner=%s AND trip_type=%s AND filter_flags=%s;
+WHERE (category, train_number, owner, trip_type, filter_flags) IN (VALUES %s);
 """
 
-SQL_UPSERT_FACT_PLANNED = """
+# per-session staging table, filled by COPY and merged once per snapshot
+SQL_CREATE_STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS stg_fact_planned (
+  stg_id             BIGSERIAL,
+  station_key        BIGINT,
+  train_key          BIGINT,
+  snapshot_time_key  BIGINT,
+  stop_id            TEXT,
+  event_type         CHAR(1),
+  planned_time_key   BIGINT,
+  planned_platform   TEXT,
+  line               TEXT,
+  planned_path       TEXT
+);
+"""
+
+# train_key first: it is the only column the main process adds (stage_rows),
+# the workers pre-encode everything after it
+STG_COLUMNS = (
+    "train_key", "station_key", "snapshot_time_key",
+    "stop_id", "event_type", "planned_time_key",
+    "planned_platform", "line", "planned_path",
+)
+
+SQL_COPY_STAGING = f"COPY stg_fact_planned ({', '.join(STG_COLUMNS)}) FROM STDIN"
+
+# DISTINCT ON: a key may only be touched once per INSERT -> last copied row wins
+SQL_MERGE_FACT_PLANNED = """
 INSERT INTO fact_train_movement (
   station_key, train_key, snapshot_time_key,
   stop_id, event_type,
@@ -148,7 +164,13 @@ INSERT INTO fact_train_movement (
   event_status, planned_platform, changed_platform,
   line, planned_path, delay_minutes, is_cancelled
 )
-VALUES (%s,%s,%s,%s,%s,%s,NULL,NULL,%s,NULL,%s,%s,NULL,false)
+SELECT DISTINCT ON (snapshot_time_key, station_key, stop_id, event_type)
+  station_key, train_key, snapshot_time_key,
+  stop_id, event_type,
+  planned_time_key, NULL::bigint, NULL::char(1), planned_platform, NULL::text,
+  line, planned_path, NULL::int, false
+FROM stg_fact_planned
+ORDER BY snapshot_time_key, station_key, stop_id, event_type, stg_id DESC
 ON CONFLICT (snapshot_time_key, station_key, stop_id, event_type)
 DO UPDATE SET
   train_key = EXCLUDED.train_key,
@@ -159,51 +181,128 @@ DO UPDATE SET
 """
 
 
-def upsert_time(cur, dt: datetime, cache: set[int]) -> int:
-    k = time_key(dt)
-    if k in cache:
-        return k
-    cur.execute(SQL_UPSERT_TIME, (
-        k, dt, dt.date(), dt.hour, dt.minute, dt.isoweekday(), (dt.weekday() >= 5)
-    ))
-    cache.add(k)
-    return k
+# ingest session settings; synchronous_commit=off means a crash may lose the
+# last snapshot commit(s) -> just re-run, the ingest is idempotent
+SQL_TUNE_SESSION = (
+    "SET synchronous_commit = off;",
+    "SET work_mem = '256MB';",
+)
 
 
-def get_train_key(cur, tl: dict, train_cache: dict) -> int:
-    # ensure stable UNIQUE key even if missing
-    category = tl.get("c") or "UNK"
-    number   = tl.get("n") or "UNK"
-    owner    = tl.get("o") or ""
-    ttype    = tl.get("t") or ""
-    flags    = tl.get("f") or ""
+def tune_session(cur):
+    for stmt in SQL_TUNE_SESSION:
+        cur.execute(stmt)
 
-    key = (category, number, owner, ttype, flags)
-    if key in train_cache:
-        return train_cache[key]
 
-    cur.execute(SQL_UPSERT_TRAIN, key)
-    cur.execute(SQL_SELECT_TRAIN_KEY, key)
-    train_key = cur.fetchone()[0]
-    train_cache[key] = train_key
-    return train_key
+def set_fact_autovacuum(conn, enabled: bool):
+    # --unsafe-fast: autovacuum off during ingest, back on + VACUUM ANALYZE after
+    conn.commit()
+    conn.autocommit = True  # VACUUM can't run inside a transaction
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE fact_train_movement SET (autovacuum_enabled = %s);", (enabled,))
+            if enabled:
+                cur.execute("SET maintenance_work_mem = '1GB';")
+                cur.execute("VACUUM ANALYZE fact_train_movement;")
+    finally:
+        conn.autocommit = False
+
+
+# -----------------------
+# Trains + staging
+# -----------------------
+def resolve_train_keys(cur, keys: set, train_cache: dict):
+    # one multi-row INSERT + one SELECT for all uncached trains of a batch
+    new = sorted(k for k in keys if k not in train_cache)
+    if not new:
+        return
+    execute_values(cur, SQL_INSERT_TRAINS, new, page_size=1000)
+    for train_key, *key in execute_values(cur, SQL_SELECT_TRAINS, new, page_size=1000, fetch=True):
+        train_cache[tuple(key)] = train_key
+
+
+def stage_rows(cur, rows: list, train_cache: dict):
+    # rows = (train natural key, COPY text of the other columns):
+    # resolve trains, prepend train_key, COPY -- no tuples rebuilt per row
+    resolve_train_keys(cur, {train for train, _ in rows}, train_cache)
+    buf = io.StringIO()
+    for train, tail in rows:
+        buf.write(f"{train_cache[train]}\t{tail}\n")
+    buf.seek(0)
+    cur.copy_expert(SQL_COPY_STAGING, buf)
+
+
+# -----------------------
+# XML parsing (pool worker processes)
+# -----------------------
+_name_to_eva: dict[str, int] = {}
+_station_key_by_eva: dict[int, int] = {}
+
+
+def init_parser(name_to_eva: dict, station_key_by_eva: dict):
+    # pool initializer: station maps are sent once per worker, not per task
+    global _name_to_eva, _station_key_by_eva
+    _name_to_eva = name_to_eva
+    _station_key_by_eva = station_key_by_eva
+
+
+def parse_one_xml(args) -> tuple[str, list]:
+    """
+    One station xml -> (status, rows), status is "ok", "bad_xml"
+    or "skipped_station". Row = (train natural key, COPY line of the other
+    STG_COLUMNS), train_key gets resolved in the main process (stage_rows).
+    """
+    fn, fp, snap_key = args
+    elements = iter_s(fp)
+    try:
+        root = next(elements)
+    except Exception:
+        # malformed xml; skip (or log)
+        return "bad_xml", []
+
+    station_name = station_from_root_or_filename(root.attrib, fn)
+    eva = _name_to_eva.get(norm_name(station_name))
+    if eva is None:
+        return "skipped_station", []
+    station_key = _station_key_by_eva.get(int(eva))
+    if station_key is None:
+        return "skipped_station", []
+
+    rows = []
+    try:
+        for s in elements:
+            rows.extend(process_planned_element(s, station_key, snap_key))
+    except ET.XMLSyntaxError:
+        # malformed xml; skip (or log)
+        return "bad_xml", []
+
+    return "ok", rows
 
 
 # -----------------------
 # Main ingestion: planned timetables
 # -----------------------
-def ingest_timetables(cur, week_timetable_dir: str, station_json_path: str, batch_size: int = 500):
+def ingest_timetables(cur, week_timetable_dir: str, station_json_path: str, batch_size: int = 500,
+                      workers: int | None = None):
     eva_to_station, name_to_eva = build_station_maps(station_json_path)
 
+    snapshots = list(iter_snapshot_dirs(week_timetable_dir))
+    if snapshots:
+        names = [name for name, _ in snapshots]  # YYMMDDHHMM sorts by time
+        check_dim_time_covers(cur, min(names), max(names))
+
+    tune_session(cur)
+
     # 1) upsert dim_station
     station_rows = [(eva, name, lat, lon) for eva, (name, lat, lon) in eva_to_station.items()]
-    execute_batch(cur, SQL_UPSERT_STATION, station_rows, page_size=200)
+    execute_values(cur, SQL_UPSERT_STATION, station_rows, page_size=1000)
 
     # 2) build eva -> station_key cache
     cur.execute("SELECT eva, station_key FROM dim_station;")
     station_key_by_eva = {int(e): int(k) for (e, k) in cur.fetchall()}
 
-    time_cache: set[int] = set()
+    cur.execute(SQL_CREATE_STAGING)
+
     train_cache: dict[tuple, int] = {}
 
     snap_count = 0
@@ -211,70 +310,44 @@ def ingest_timetables(cur, week_timetable_dir: str, station_json_path: str, batc
     inserted_rows = 0
     skipped_station = 0
 
-    for snapshot_str, snapshot_path in iter_snapshot_dirs(week_timetable_dir):
-        snap_dt = parse_yymmddhhmm(snapshot_str)
-        snap_key = upsert_time(cur, snap_dt, time_cache)
-
-        rows = []
-        # iterate all station xmls in this snapshot
-        for fn, fp in iter_xml_files(snapshot_path):
-            xml_count += 1
-            try:
-                with open(fp, "rb") as f:
-                    root = ET.fromstring(f.read())
-            except Exception:
-                # malformed xml; skip (or log)
-                continue
-
-            station_name = station_from_root_or_filename(root, fn)
-            eva = name_to_eva.get(norm_name(station_name))
-            if eva is None:
-                skipped_station += 1
-                continue
-            station_key = station_key_by_eva.get(int(eva))
-            if station_key is None:
-                skipped_station += 1
-                continue
-
-            for s in root.findall("s"):
-                stop_id = s.attrib.get("id")
-                tl_node = s.find("tl")
-                tl = tl_node.attrib if tl_node is not None else {}
-                train_key = get_train_key(cur, tl, train_cache)
-
-                for tag, etype in (("ar", "A"), ("dp", "D")):
-                    ev = s.find(tag)
-                    if ev is None:
-                        continue
-
-                    pt = ev.attrib.get("pt")
-                    pt_key = upsert_time(cur, parse_yymmddhhmm(pt), time_cache) if pt else None
-
-                    rows.append((
-                        station_key,
-                        train_key,
-                        snap_key,
-                        stop_id,
-                        etype,
-                        pt_key,
-                        ev.attrib.get("pp"),
-                        ev.attrib.get("l"),
-                        ev.attrib.get("ppth"),
-                    ))
-
-                    if len(rows) >= batch_size:
-                        execute_batch(cur, SQL_UPSERT_FACT_PLANNED, rows, page_size=200)
-                        inserted_rows += len(rows)
-                        rows.clear()
-
-        if rows:
-            execute_batch(cur, SQL_UPSERT_FACT_PLANNED, rows, page_size=200)
-            inserted_rows += len(rows)
-
-        # commit once per snapshot folder 
-        cur.connection.commit()
-        snap_count += 1
-        print(f"[snapshot {snapshot_str}] committed. total_snapshots={snap_count}, total_xml={xml_count}, total_fact_rows_upserted~={inserted_rows}, skipped_station={skipped_station}")
+    # xml parsing is cpu-only and per file -> pool; DB work stays in this process
+    with multiprocessing.Pool(workers or os.cpu_count(), initializer=init_parser,
+                              initargs=(name_to_eva, station_key_by_eva)) as pool:
+        for snapshot_str, snapshot_path in snapshots:
+            snap_key = safe_timekey_from_attr(snapshot_str)  # no datetime round trip
+
+            rows = []
+            staged = 0
+            # iterate all station xmls in this snapshot (imap keeps file order)
+            tasks = [(fn, fp, snap_key) for fn, fp in iter_xml_files(snapshot_path)]
+            for status, file_rows in pool.imap(parse_one_xml, tasks, chunksize=16):
+                xml_count += 1
+                if status == "bad_xml":
+                    continue
+                if status == "skipped_station":
+                    skipped_station += 1
+                    continue
+
+                rows.extend(file_rows)
+                if len(rows) >= batch_size:
+                    stage_rows(cur, rows, train_cache)
+                    staged += len(rows)
+                    rows.clear()
+
+            if rows:
+                stage_rows(cur, rows, train_cache)
+                staged += len(rows)
+
+            if staged:
+                # one set-based upsert per snapshot
+                cur.execute(SQL_MERGE_FACT_PLANNED)
+                inserted_rows += cur.rowcount
+                cur.execute("TRUNCATE stg_fact_planned;")
+
+            # commit once per snapshot folder 
+            cur.connection.commit()
+            snap_count += 1
+            print(f"[snapshot {snapshot_str}] committed. total_snapshots={snap_count}, total_xml={xml_count}, total_fact_rows_upserted~={inserted_rows}, skipped_station={skipped_station}")
 
     print(f"[DONE] snapshots={snap_count}, xml_files={xml_count}, fact_rows_upserted~={inserted_rows}, skipped_station={skipped_station}")
 
@@ -286,6 +359,11 @@ def main():
     ap.add_argument("--station-json", required=True,
                     help="Path to station_data.json")
     ap.add_argument("--batch-size", type=int, default=500)
+    ap.add_argument("--workers", type=int, default=os.cpu_count(),
+                    help="processes for xml parsing (default: all cores)")
+    ap.add_argument("--unsafe-fast", action="store_true",
+                    help="autovacuum off on fact_train_movement while ingesting "
+                         "(back on + VACUUM ANALYZE afterwards)")
 
     # DB config (args override env)
     ap.add_argument("--pg-host", default=os.getenv("PGHOST", "localhost"))
@@ -310,7 +388,15 @@ def main():
     cur = conn.cursor()
 
     try:
-        ingest_timetables(cur, args.week_dir, args.station_json, batch_size=args.batch_size)
+        if args.unsafe_fast:
+            set_fact_autovacuum(conn, False)
+        try:
+            ingest_timetables(cur, args.week_dir, args.station_json, batch_size=args.batch_size,
+                              workers=args.workers)
+        finally:
+            if args.unsafe_fast:
+                conn.rollback()  # leftovers of a failed snapshot
+                set_fact_autovacuum(conn, True)
     finally:
         cur.close()
         conn.close()
@@ -0,0 +1,118 @@
+
+"""
+Fill dim_time once, at 1-minute resolution, for a whole date range.
+
+time_key is just YYYYMMDDHHMM of the timestamp, so there is nothing to look up:
+with every minute of the range already in dim_time, the ingest scripts can use
+the keys as plain ints and never insert into dim_time themselves.
+
+Run this before ingest_timetables.py / ingest_changes.py. The range has to
+cover every pt/ct/snapshot time in the data, otherwise the fact merge fails on
+the dim_time foreign keys. Re-running is safe (ON CONFLICT DO NOTHING).
+Both ingests call check_dim_time_covers() up front, so a missing range shows up
+as a clear message instead of an FK violation in the middle of a run.
+"""
+
+import os
+import argparse
+
+import psycopg2
+
+
+# One set-based statement, generated on the server.
+SQL_PREPOPULATE_TIME = """
+INSERT INTO dim_time (time_key, ts, date, hour, minute, dow, is_weekend)
+SELECT
+  to_char(g, 'YYYYMMDDHH24MI')::bigint,
+  g,
+  g::date,
+  extract(hour FROM g),
+  extract(minute FROM g),
+  extract(isodow FROM g),
+  extract(isodow FROM g) >= 6
+FROM generate_series(%s::timestamp, %s::timestamp, interval '1 minute') AS g
+ON CONFLICT DO NOTHING;
+"""
+
+
+# Minutes of [start, end] that have no dim_time row, plus what dim_time covers.
+SQL_DIM_TIME_GAPS = """
+SELECT
+  (SELECT count(*)
+   FROM generate_series(%s::timestamp, %s::timestamp, interval '1 minute') AS g
+   WHERE NOT EXISTS (SELECT 1 FROM dim_time d WHERE d.ts = g)),
+  (SELECT min(ts) FROM dim_time),
+  (SELECT max(ts) FROM dim_time);
+"""
+
+
+def snapshot_ts(snapshot_str: str) -> str:
+    # YYMMDDHHMM folder name -> 'YYYY-MM-DD HH:MI' (what --start/--end take)
+    s = snapshot_str
+    return f"20{s[0:2]}-{s[2:4]}-{s[4:6]} {s[6:8]}:{s[8:10]}"
+
+
+def check_dim_time_covers(cur, first_snapshot: str, last_snapshot: str):
+    """
+    Exit with a clear message unless dim_time has every minute from the first
+    to the last snapshot folder (YYMMDDHHMM). pt/ct outside that window are
+    not checked here; the default prepopulate range leaves plenty of margin.
+    """
+    start, end = snapshot_ts(first_snapshot), snapshot_ts(last_snapshot)
+    cur.execute(SQL_DIM_TIME_GAPS, (start, end))
+    missing, covered_from, covered_to = cur.fetchone()
+    if not missing:
+        return
+    if covered_from is None:
+        have = "dim_time is empty"
+    else:
+        have = f"dim_time covers {covered_from:%Y-%m-%d %H:%M} .. {covered_to:%Y-%m-%d %H:%M}"
+    raise SystemExit(
+        f"dim_time is missing {missing} minute(s) of the snapshots {start} .. {end} ({have}). "
+        f"Run prepopulate_dim_time.py with a --start/--end covering the data first."
+    )
+
+
+def prepopulate_dim_time(cur, start: str, end: str) -> int:
+    cur.execute(SQL_PREPOPULATE_TIME, (start, end))
+    inserted = cur.rowcount
+    cur.connection.commit()
+    return inserted
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Pre-populate dim_time (1-minute resolution) in PostgreSQL.")
+    ap.add_argument("--start", default="2024-01-01 00:00",
+                    help="First minute to generate (inclusive)")
+    ap.add_argument("--end", default="2026-12-31 23:59",
+                    help="Last minute to generate (inclusive)")
+
+    ap.add_argument("--pg-host", default=os.getenv("PGHOST", "localhost"))
+    ap.add_argument("--pg-port", type=int, default=int(os.getenv("PGPORT", "5432")))
+    ap.add_argument("--pg-db", default=os.getenv("PGDATABASE", ""))
+    ap.add_argument("--pg-user", default=os.getenv("PGUSER", ""))
+    ap.add_argument("--pg-password", default=os.getenv("PGPASSWORD", ""))
+
+    args = ap.parse_args()
+    if not args.pg_db or not args.pg_user:
+        raise SystemExit("DB config missing. Use --pg-db/--pg-user or set PGDATABASE/PGUSER.")
+
+    conn = psycopg2.connect(
+        host=args.pg_host,
+        port=args.pg_port,
+        dbname=args.pg_db,
+        user=args.pg_user,
+        password=args.pg_password,
+    )
+    conn.autocommit = False
+    cur = conn.cursor()
+    try:
+        inserted = prepopulate_dim_time(cur, args.start, args.end)
+        print(f"[DONE] dim_time rows inserted={inserted} ({args.start} .. {args.end})")
+    finally:
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()